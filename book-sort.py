@@ -1,7 +1,39 @@
+import asyncio
+import errno
+import logging
 import os
+import shutil
 import string
+import struct
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from unicodedata import normalize
+import aiofiles.os
+import diskcache
 import epub_meta
-import pdfx
+import pypdf
+
+# Translate tables for slug(), built once so each call is a C-level pass
+# instead of per-call regex/replace work. Hyphens stay ("Title - Author"),
+# underscores become spaces, everything else from punctuation is dropped.
+_DEL = str.maketrans({c: None for c in string.punctuation if c not in "-_"})
+_SPACE = str.maketrans({"_": " "})
+
+# Gate the per-file info chatter behind BOOKSORT_VERBOSE=1; logging defers
+# formatting until a record is actually emitted, so the hot path pays nothing
+# when quiet, and stdout isn't contended under the process pool
+VERBOSE = os.environ.get("BOOKSORT_VERBOSE", "") == "1"
+logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO if VERBOSE else logging.WARNING)
+log = logging.getLogger(__name__)
+
+# Cache of already-extracted (title, author) strings, keyed by path + mtime + size
+# so a cron re-run over files we've already seen costs a stat instead of a parse.
+# diskcache is multiprocess-safe, so the pool workers can share it.
+# WAL + synchronous=NORMAL avoids an fsync per write under the pool; losing
+# the last few entries in a crash just means re-parsing those files next run.
+META_CACHE = diskcache.Cache("/tmp/booksort_meta_cache",
+                             sqlite_journal_mode="WAL",
+                             sqlite_synchronous="NORMAL")
 
 # MACOS paths
 # export BOOKSORT_ISSUES_PATH=/Users/bvia/Development/Personal/booksort/issues
@@ -13,39 +45,128 @@ import pdfx
 # export BOOKSORT_OUTPUT_PATH=/mnt/storage/Books/Organized
 # export BOOKSORT_INPUT_PATH=/mnt/storage/Books/_unorganized
 
-# Main function - reads environment variables and calls sort_books
+# Directory configuration, read from the environment once at import
+INPUT_DIR = os.environ.get("BOOKSORT_INPUT_PATH", "/mnt/storage/Books/_unorganized")
+OUTPUT_DIR = os.environ.get("BOOKSORT_OUTPUT_PATH", "/mnt/storage/Books/Organized")
+ISSUES_DIR = os.environ.get("BOOKSORT_ISSUES_PATH", "/mnt/storage/Books/_issues")
+
+
+# Main function - calls sort_books with the configured directories
 def main():
-    inputPath = os.environ.get("BOOKSORT_INPUT_PATH", "/mnt/storage/Books/_unorganized")
-    outputPath = os.environ.get("BOOKSORT_OUTPUT_PATH", "/mnt/storage/Books/Organized")
-    issuesPath = os.environ.get("BOOKSORT_ISSUES_PATH", "/mnt/storage/Books/_issues")
-    sort_books(inputPath, outputPath, issuesPath)
-    
+    sort_books(INPUT_DIR, OUTPUT_DIR, ISSUES_DIR)
+
 
 # python function to sort epub and pdf files into title-author folders by reading their metadata
+# Metadata extraction (the slow, CPU-bound part) runs across a process pool,
+# then the moves fan out on the event loop so many renames are in flight at once.
 def sort_books(inputPath: string, outputPath: string, issuesPath: string):
-    files = getAllFiles(inputPath);
-    print("INFO: Loaded " + str(len(files)) + " files.")
-    for file in files:
-        TitleAndAuthorString = ""
-        if file.endswith(".epub"):
-            TitleAndAuthorString = getEpubTitleAndAuthorPath(file)
-        if file.endswith(".pdf"):
-            TitleAndAuthorString = getPdfTitleAndAuthorPath(file)
-
-        extension = getFileExtension(file)
-        
+    asyncio.run(sort_books_async(inputPath, outputPath, issuesPath))
+
+
+async def sort_books_async(inputPath: string, outputPath: string, issuesPath: string):
+    # files already present in the organized tree (hardlinks, overlapping
+    # trees) get skipped on an inode check before we pay for a parse
+    destInodes = getDestInodes(outputPath)
+    files = (f for f in getAllFiles(inputPath) if statDevInode(f) not in destInodes)
+    # executor.map consumes the walk generator lazily in chunks, so extraction
+    # starts while the walk is still going and we never hold the full path list
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        results = list(executor.map(readBook, files, chunksize=8))
+    log.info("Loaded %d files.", len(results))
+    # cap how many renames we throw at the kernel at once
+    limit = asyncio.Semaphore(64)
+    # folders we've already made this run, so a 50-book series costs one mkdir
+    created_dirs = set()
+    # slug every folder name in one batched pass rather than per book
+    slugs = batchSlug([TitleAndAuthorString or "" for file, TitleAndAuthorString in results])
+    await asyncio.gather(*[moveBook(file, TitleAndAuthorString, bookPath, outputPath, issuesPath, limit, created_dirs)
+                           for (file, TitleAndAuthorString), bookPath in zip(results, slugs)])
+
+
+# Pool worker: pairs a file path with its extracted title-author string
+def readBook(filepath: string):
+    return filepath, getTitleAndAuthorPath(filepath)
+
+
+# Normalizes a title-author string into a filesystem-safe ascii folder name:
+# one NFKD pass, two translate passes, and a C-level whitespace collapse
+def slug(text: string):
+    t = normalize("NFKD", text).encode("ascii", "ignore").decode()
+    t = t.translate(_DEL).translate(_SPACE)
+    return " ".join(t.split())
 
+
+# slug() over a whole batch: join the names, run the normalize/encode/translate
+# machinery once over the combined blob, and split back out - N names cost one
+# C-level pass each step instead of N Python calls
+def batchSlug(texts: list):
+    blob = "\n".join(t.replace("\n", " ") for t in texts)
+    blob = normalize("NFKD", blob).encode("ascii", "ignore").decode()
+    blob = blob.translate(_DEL).translate(_SPACE)
+    return [" ".join(line.split()) for line in blob.split("\n")]
+
+
+# Returns the title-author string for a file, going through META_CACHE so
+# unchanged files skip the parse entirely
+def getTitleAndAuthorPath(filepath: string):
+    st = os.stat(filepath)
+    key = (filepath, st.st_mtime_ns, st.st_size)
+    hit = META_CACHE.get(key)
+    if hit is not None:
+        return hit
+    TitleAndAuthorString = extractTitleAndAuthorPath(filepath)
+    if TitleAndAuthorString is not None:
+        META_CACHE[key] = TitleAndAuthorString
+    return TitleAndAuthorString
+
+
+# Dispatches to the right metadata reader for a file, based on its extension
+def extractTitleAndAuthorPath(filepath: string):
+    if filepath.endswith(".epub"):
+        return getEpubTitleAndAuthorPath(filepath)
+    if filepath.endswith(".pdf"):
+        return getPdfTitleAndAuthorPath(filepath)
+    if filepath.endswith((".mobi", ".azw3")):
+        return getMobiTitleAndAuthorPath(filepath)
+    return None
+
+
+# Moves a single book into its title-author folder, or to the issues folder
+# if we couldn't work out what it is. There's no native async rename, so the
+# rename itself runs on the loop's thread pool per the usual aiofiles pattern.
+async def moveBook(file: string, TitleAndAuthorString: string, bookPath: string, outputPath: string, issuesPath: string, limit: asyncio.Semaphore, created_dirs: set):
+    extension = getFileExtension(file)
+    loop = asyncio.get_running_loop()
+
+    async with limit:
         # if bookpath is not none and doesn't contain unknown
         if TitleAndAuthorString and "Unknown" not in TitleAndAuthorString:
-            if not os.path.exists(outputPath + "/" + TitleAndAuthorString):
-                os.makedirs(outputPath + "/" + TitleAndAuthorString)
-            print("SUCCESS: Moving " + TitleAndAuthorString)
-            os.rename(file, outputPath + "/" + TitleAndAuthorString + "/" + TitleAndAuthorString + extension)
+            # bookPath comes pre-slugged from the batch pass in sort_books_async
+            destDir = os.path.join(outputPath, bookPath)
+            if destDir not in created_dirs:
+                # exist_ok because two books in the same series can race on the folder
+                await aiofiles.os.makedirs(destDir, exist_ok=True)
+                created_dirs.add(destDir)
+            log.info("Moving %s", bookPath)
+            await loop.run_in_executor(None, _fast_move, file, os.path.join(destDir, bookPath + extension))
             # My desired file output path is <BooksDir>/<Title> - <Author>/<Title> - <Author>.{pdf,epub,etc}
         else:
-            print("WARN: Moving " + getFileName(file) + " to issues folder")
-            os.rename(file, issuesPath + "/" + getFileName(file))
-            continue
+            log.warning("Moving %s to issues folder", getFileName(file))
+            await loop.run_in_executor(None, _fast_move, file, os.path.join(issuesPath, getFileName(file)))
+
+
+# Moves like os.rename on the same filesystem, but survives crossing devices
+# (where rename raises EXDEV) by falling back to copy + unlink
+def _fast_move(src: string, dst: string):
+    try:
+        os.rename(src, dst)
+    except OSError as e:
+        if e.errno == errno.EXDEV:
+            shutil.copy2(src, dst)
+            os.unlink(src)
+        else:
+            raise
+
 
 # Returns just the file name from a path
 # ie, "/unsorted-books/Book.epub" -> "Book.epub"
@@ -53,31 +174,77 @@ def getFileName(filepath: string):
     return os.path.basename(filepath)
 
 
-# Returns all files in a directory
+# File extensions we know how to read metadata from
+EXTS = (".pdf", ".epub", ".mobi", ".azw3")
+
+# Directory names we never want to descend into (zip cruft, trash, courseware)
+IGNORE_DIRS = {"__MACOSX", ".Trash", "Masterclass"}
+
+
+# Returns the (device, inode) pair of every file already in the organized
+# tree, collected in one scandir pass over the <output>/<title - author>/
+# folders so idempotent re-runs can recognize an already-sorted file from a
+# stat alone. Inode numbers are only unique per filesystem, so the device id
+# has to be part of the key - input and output may live on different devices.
+def getDestInodes(outputPath: string):
+    inodes = set()
+    try:
+        entries = list(os.scandir(outputPath))
+    except FileNotFoundError:
+        return inodes
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            for f in os.scandir(entry.path):
+                if f.is_file(follow_symlinks=False):
+                    st = f.stat(follow_symlinks=False)
+                    inodes.add((st.st_dev, st.st_ino))
+    return inodes
+
+
+# Returns a file's (device, inode) pair for membership checks against the set
+# that getDestInodes builds
+def statDevInode(filepath: string):
+    st = os.stat(filepath)
+    return (st.st_dev, st.st_ino)
+
+
+# Yields all book files in a directory as a recursive scandir walk - endswith
+# on a tuple is a single C-level check, and is_file on a DirEntry uses the
+# cached dirent instead of a fresh stat
 def getAllFiles(path: string):
-    files = []
-    for r, d, f in os.walk(path):
-        for file in f:
-            if file.endswith(".pdf") or file.endswith(".epub"):
-                files.append(os.path.join(r, file))
-    print(files)
-    return files
+    try:
+        entries = os.scandir(path)
+    except OSError as e:
+        # os.walk swallowed unreadable/missing directories (onerror=None);
+        # keep that behavior instead of aborting the whole sort mid-walk
+        log.warning("Skipping unreadable directory: %s", e)
+        return
+    for entry in entries:
+        # hidden files/folders, known junk trees, and Kindle .sdr sidecar
+        # folders get pruned here so we never stat or descend into them
+        if entry.name.startswith(".") or entry.name in IGNORE_DIRS:
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            if not entry.name.endswith(".sdr"):
+                yield from getAllFiles(entry.path)
+        elif entry.name.endswith(EXTS) and entry.is_file(follow_symlinks=False):
+            yield entry.path
 
 
 # Returns the title and author of an epub file in the format "Title - Author"
 def getEpubTitleAndAuthorPath(filepath: string):
     try:
-        print("INFO: Getting metadata for: " + filepath)
+        log.info("Getting metadata for: %s", filepath)
         data = epub_meta.get_epub_metadata(filepath)
         if data is None:
-            print("WARN: Metadata could not be extracted for: " + filepath)
+            log.warning("Metadata could not be extracted for: %s", filepath)
             return None
         title = data['title'] or "Unknown"
         authors =", ".join(data['authors']) or "Unknown"
-        print("INFO: Got metadata for " + filepath + ": " + title + " - " + authors)
+        log.info("Got metadata for %s: %s - %s", filepath, title, authors)
         return(title + " - " + authors)
     except epub_meta.EPubException as e:
-        print(e)
+        log.error(e)
         return None
 
 # Returns the file extension of a file
@@ -85,32 +252,96 @@ def getFileExtension(file):
     return os.path.splitext(file)[1]
 
 # Returns the title and author of a pdf file in the format "Title - Author"
+# pypdf only reads the trailer and cross-ref table for this, where pdfx built
+# a whole text-and-link extractor before handing back the /Info dict
 def getPdfTitleAndAuthorPath(filepath: string):
-    issuesPath = os.environ["BOOKSORT_ISSUES_PATH"]
-    file = filepath
     try:
-        print("INFO: Getting metadata for: " + filepath)
-        pdf = pdfx.PDFx(filepath)
-        metadata = pdf.get_metadata()
-        title = metadata.get("Title") or "Unknown"
-        authors = metadata.get("Author") or "Unknown"
-        print("INFO: Got metadata for " + filepath + ": " + title + " - " + authors)
+        log.info("Getting metadata for: %s", filepath)
+        metadata = pypdf.PdfReader(filepath, strict=False).metadata
+        if metadata is None:
+            log.warning("Metadata could not be extracted for: %s", filepath)
+            return None
+        title = metadata.title or "Unknown"
+        authors = metadata.author or "Unknown"
+        log.info("Got metadata for %s: %s - %s", filepath, title, authors)
         return(title + " - " + authors)
-    except pdfx.exceptions.PDFInvalidError as e:
-        print(e)
-        print("ERROR: Moving " + getFileName(file) + " to issues folder")
-        os.rename(file, issuesPath + "/" + getFileName(file))
-        return None
-    except pdfx.exceptions.PDFExtractionError as e:
-        print(e)
-        print("ERROR: Moving " + getFileName(file) + " to issues folder")
-        os.rename(file, issuesPath + "/" + getFileName(file))
+    except (pypdf.errors.PyPdfError, OSError) as e:
+        log.error(e)
         return None
-    except pdfx.exceptions.FileNotFoundError as e:
-        print(e)
-        print("ERROR: Moving " + getFileName(file) + " to issues folder")
-        os.rename(file, issuesPath + "/" + getFileName(file))
+
+# Returns the title and author of a mobi/azw3 file in the format "Title - Author"
+# Reads the MOBI header directly in-process instead of unpacking the whole book
+def getMobiTitleAndAuthorPath(filepath: string):
+    try:
+        log.info("Getting metadata for: %s", filepath)
+        title, authors = readMobiMetadata(filepath)
+        title = title or "Unknown"
+        authors = authors or "Unknown"
+        log.info("Got metadata for %s: %s - %s", filepath, title, authors)
+        return(title + " - " + authors)
+    except (OSError, ValueError, struct.error) as e:
+        log.error(e)
+        return ebookMetaFallback(filepath)
+
+# Pulls title and author out of a MOBI file's record 0 (PalmDOC + MOBI + EXTH headers)
+# EXTH record 100 is the author, 503 is the updated title
+def readMobiMetadata(filepath: string):
+    with open(filepath, "rb") as f:
+        pdb = f.read(78)
+        if pdb[60:68] != b"BOOKMOBI":
+            raise ValueError("Not a MOBI file: " + filepath)
+        numRecords = struct.unpack(">H", pdb[76:78])[0]
+        recordList = f.read(numRecords * 8)
+        record0Start = struct.unpack(">I", recordList[0:4])[0]
+        if numRecords > 1:
+            record0End = struct.unpack(">I", recordList[8:12])[0]
+        else:
+            record0End = os.path.getsize(filepath)
+        f.seek(record0Start)
+        record0 = f.read(record0End - record0Start)
+
+    if record0[16:20] != b"MOBI":
+        raise ValueError("No MOBI header in: " + filepath)
+    headerLength = struct.unpack(">I", record0[20:24])[0]
+    titleOffset, titleLength = struct.unpack(">II", record0[84:92])
+    title = record0[titleOffset:titleOffset + titleLength].decode("utf-8", "replace")
+    exthFlags = struct.unpack(">I", record0[128:132])[0]
+
+    author = None
+    exthTitle = None
+    if exthFlags & 0x40:
+        exth = record0[16 + headerLength:]
+        if exth[0:4] == b"EXTH":
+            count = struct.unpack(">I", exth[8:12])[0]
+            pos = 12
+            for _ in range(count):
+                recType, recLength = struct.unpack(">II", exth[pos:pos + 8])
+                value = exth[pos + 8:pos + recLength]
+                if recType == 100 and author is None:
+                    author = value.decode("utf-8", "replace")
+                if recType == 503:
+                    exthTitle = value.decode("utf-8", "replace")
+                pos += recLength
+    return (exthTitle or title), author
+
+# Last resort: shell out to calibre's ebook-meta if it's installed
+def ebookMetaFallback(filepath: string):
+    try:
+        out = subprocess.run(["ebook-meta", filepath], capture_output=True, text=True).stdout
+    except OSError as e:
+        log.error(e)
         return None
-    
+    # one linear pass over the output instead of a regex scan per field,
+    # and the dict keeps Publisher/ISBN/etc. around for free if we want them
+    fields = {}
+    for line in out.splitlines():
+        k, sep, v = line.partition(":")
+        if sep:
+            fields[k.strip()] = v.strip()
+    title = fields.get("Title") or "Unknown"
+    authors = fields.get("Author(s)") or "Unknown"
+    return title + " - " + authors
+
 
-main()
+if __name__ == "__main__":
+    main()